@@ -120,6 +120,11 @@ class FGVCDataModule(BaseDataModule):
                 batch[0] = T.functional.normalize(batch[0].float().div_(255), *fgvcdata.IMAGENET_STATS)
             elif self.normalize == 'in21k':
                 batch[0] = batch[0].float().div_(255)
+
+        # convert images to the channels_last memory format if the model uses it
+        model_conf = getattr(self.trainer.lightning_module, 'model_conf', None)
+        if getattr(model_conf, 'channels_last', False):
+            batch[0] = batch[0].contiguous(memory_format=torch.channels_last)
         return batch
 
 
@@ -1,5 +1,6 @@
 '''
 '''
+import inspect
 from typing import Any, Dict, List, Optional, Union
 
 import pytorch_lightning as pl
@@ -63,7 +64,7 @@ def make_parameter_groups(
     Pretrained weights will get a lower learning rate. Bias parameters and parameters in Normalization
     layers won't have weight decay applied to them.
     '''
-    finetune_list = set(finetune_list) or []
+    finetune_list = set(finetune_list) if finetune_list else set()
 
     assignments = []
         
@@ -75,12 +76,14 @@ def make_parameter_groups(
             'no_decay': {'params': [], 'weight_decay': 0.0, 'lr': lr},
         }
 
-    def _divy(name: str, module: torch.nn.Module, finetune: bool=False):
-        '''Recursively traverse modules and add parameters to param_groups. Doing it this
-        way allows the finetune flag to be inherited by all child modules, and also allows
-        for checking whether each module is a normalization layer.
-        '''
-        finetune = finetune or name in finetune_list
+    # a module is finetuned if it, or any of its ancestors, is in finetune_list
+    finetune_prefixes = tuple(f'{name}.' for name in finetune_list)
+
+    # named_modules traverses the whole module tree, giving the full dotted name of each module
+    for name, module in model.named_modules():
+        if not name:
+            continue
+        finetune = name in finetune_list or name.startswith(finetune_prefixes)
         key1 = 'finetune' if finetune else 'scratch'
         norm = 'Norm' in module.__class__.__name__
         # add module's direct parameters
@@ -90,12 +93,6 @@ def make_parameter_groups(
                 key2 = 'no_decay'
             param_groups[key1][key2]['params'].append(param)
             assignments.append(('.'.join((name, pname)), key1, key2))
-        # recurse to child modules, inheriting finetuning flag
-        for n, m in module.named_children():
-            _divy('.'.join((name, n)), m, finetune)
-
-    for name, module in model.named_children():
-        _divy(name, module)
 
     # flatten into a list of param_group dicts
     return (
@@ -110,10 +107,13 @@ def get_optimizer(optim_name):
 
 
 def get_gpu_memory_usage():
-    '''Return a string that gives details about GPU memory usage.'''
-    avail, total = torch.cuda.mem_get_info()
-    mem_used = 100 * (1 - (avail / total))
-    return f'GPU memory used: {(total - avail) / 1024**3:.2f} of {total / 1024**3:.2f} GB ({mem_used:.2f}%)'
+    '''Return a string that gives details about GPU memory usage. Reports memory reserved by this
+    process's caching allocator, which (unlike torch.cuda.mem_get_info) doesn't synchronize the device.
+    '''
+    used = torch.cuda.memory_reserved()
+    total = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+    mem_used = 100 * used / total
+    return f'GPU memory used: {used / 1024**3:.2f} of {total / 1024**3:.2f} GB ({mem_used:.2f}%)'
 
 
 class BaseConfig:
@@ -164,6 +164,13 @@ class ModelConfig:
         pretrained (str | bool): if bool, use pretrained weights from timm. If str, should be a path
             to a model checkpoint with pretrained weights (default: True).
         model_kw (optional dict): additional keyword arguments passed to timm.create_model.
+        channels_last (bool): if True, convert the model weights and input images to the channels_last
+            memory format, which speeds up convolutions on GPUs with tensor cores. Input images are converted
+            by FGVCDataModule.on_after_batch_transfer (default: False).
+        grad_checkpointing (bool): if True, enable gradient checkpointing in the backbone (timm models only),
+            trading extra compute for lower activation memory. Raises a ValueError for methods whose backbone
+            blocks store tensors during the forward pass, such as IELT and SIM-Trans, and for PMG, whose DDP setup
+            needs find_unused_parameters, which reentrant checkpointing doesn't support (default: False).
     '''
     def __init__(
         self,
@@ -172,18 +179,25 @@ class ModelConfig:
         pretrained: Union[str, bool]=True,
         model_kw: Optional[Dict]=None,
         library: str='timm',
+        channels_last: bool=False,
+        grad_checkpointing: bool=False,
     ):
         self.model_name = model_name
         self.num_classes = num_classes
         self.pretrained = pretrained
         self.model_kw = model_kw or {}
         self.library = library
+        self.channels_last = channels_last
+        self.grad_checkpointing = grad_checkpointing
 
 
 class BaseModule(pl.LightningModule):
     '''BaseModule. Inherits from LightningModule. Base class for defining new Methods.
     Handles optimization setup and hyperparameters.
 
+    Mixed precision is configured on the Trainer (e.g. `precision: 16-mixed`), which takes care of
+    autocasting and gradient scaling; subclasses should not manage a GradScaler themselves.
+
     Args:
         base_conf (optional dict): a dictionary containing arguments to override BaseConfig defaults.
             See BaseConfig for accepted arguments.
@@ -203,6 +217,16 @@ class BaseModule(pl.LightningModule):
         if self.global_step == 1:
             self.print(get_gpu_memory_usage())
 
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer):
+        # releasing the gradients avoids a memset over every gradient buffer at each step
+        optimizer.zero_grad(set_to_none=True)
+
+    def configure_ddp(self) -> Dict:
+        '''Return keyword arguments for DistributedDataParallel that override the strategy settings.
+        Only used with src.utils.ddp_strategy.ConfigurableDDPStrategy.
+        '''
+        return {}
+
     def configure_optimizers(self) -> Any:
         finetune_lr_scale, weight_decay = self.base_conf.finetune_lr_scale, self.base_conf.weight_decay
         finetuning = getattr(self, 'finetune_list', list())
@@ -211,7 +235,13 @@ class BaseModule(pl.LightningModule):
         param_groups, assignments = make_parameter_groups(
             self, self.lr, finetune_lr_scale, weight_decay, finetuning, decouple=True
         )
-        optimizer = get_optimizer(self.base_conf.optimizer_name)(param_groups, lr=self.lr, **self.base_conf.optim_kw)
+        optim_cls = get_optimizer(self.base_conf.optimizer_name)
+        optim_kw = dict(self.base_conf.optim_kw)
+        # use the fused (single kernel) implementation of Adam/AdamW when the installed torch supports it
+        if (self.base_conf.optimizer_name in ('Adam', 'AdamW') and self.device.type == 'cuda'
+                and 'fused' in inspect.signature(optim_cls).parameters and 'foreach' not in optim_kw):
+            optim_kw.setdefault('fused', True)
+        optimizer = optim_cls(param_groups, lr=self.lr, **optim_kw)
 
         if self.trainer.is_global_zero:
            counts = {}
@@ -224,11 +254,12 @@ class BaseModule(pl.LightningModule):
             # tmp = '{{: <{}}}  {{: <{}}}  {{}}'.format(w, 8)
             # print('\n'.join(tmp.format(*x) for x in assignments))
 
-        # create learning rate schedule
+        # create learning rate schedule; each param group peaks at its own learning rate
+        max_lrs = [g['lr'] for g in param_groups]
         scheduler = {
             'scheduler': torch.optim.lr_scheduler.OneCycleLR(
                 optimizer=optimizer,
-                max_lr=[g['lr'] for g in param_groups],
+                max_lr=max_lrs,
                 total_steps=self.trainer.estimated_stepping_batches,
                 pct_start=self.base_conf.warmup,
                 cycle_momentum=False,
@@ -248,6 +279,11 @@ class ImageClassifier(BaseModule):
         base_conf (optional dict): a dictionary containing arguments to override BaseConfig defaults.
             See BaseConfig for accepted arguments.
     '''
+    # methods whose backbone blocks store tensors as a side effect of the forward pass should set this
+    # to False, since checkpointed blocks run their first forward pass without recording gradients. So should
+    # methods whose configure_ddp enables find_unused_parameters, which breaks with reentrant checkpointing
+    supports_grad_checkpointing = True
+
     def __init__(
         self,
         model_conf: Optional[dict]=None,
@@ -270,6 +306,9 @@ class ImageClassifier(BaseModule):
         # setup any additional model components
         self.setup_model()
 
+        if self.model_conf.channels_last:
+            self.to(memory_format=torch.channels_last)
+
         # setup loss function and metrics
         self.setup_objective()
         self.setup_metrics()
@@ -299,6 +338,12 @@ class ImageClassifier(BaseModule):
             if mismatch:
                 print(f' - Skipping mismatched parameters: {mismatch}')
             self.backbone.load_state_dict({k: v for k, v in state.items() if k not in mismatch}, strict=False)
+        if conf.grad_checkpointing:
+            if not self.supports_grad_checkpointing:
+                raise ValueError(f'{type(self).__name__} does not support gradient checkpointing')
+            if conf.library != 'timm':
+                raise ValueError(f'Gradient checkpointing is only supported for timm models (got {conf.library})')
+            self.backbone.set_grad_checkpointing(True)
 
     def setup_model(self):
         '''Create any additional model components beyond the backbone.'''
@@ -327,8 +372,8 @@ class ImageClassifier(BaseModule):
     def training_step(self, batch, batch_idx) -> STEP_OUTPUT:
         pred, loss, accuracy = self.step(batch, self.train_accuracy)
 
-        self.log('train/loss', loss, prog_bar=True, sync_dist=True)
-        self.log('train/acc', accuracy, prog_bar=True, sync_dist=True)
+        self.log('train/loss', loss, prog_bar=True)
+        self.log('train/acc', accuracy, prog_bar=True)
 
         return loss
     
@@ -1,7 +1,6 @@
 from copy import deepcopy
 import math
 from typing import Optional
-from pytorch_lightning.utilities.types import STEP_OUTPUT
 
 import torch
 from torch.nn.functional import normalize
@@ -128,6 +127,9 @@ class CrossLayerRefinement(torch.nn.Module):
 
 
 class IELT(ImageClassifier):
+    # blocks save tensors during the forward pass, which would have no autograd history under checkpointing
+    supports_grad_checkpointing = False
+
     def __init__(
         self,
         reinit_final_blocks: bool=True,
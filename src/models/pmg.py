@@ -8,6 +8,7 @@ Adapted from https://github.com/PRIS-CV/PMG-Progressive-Multi-Granularity-Traini
 from typing import Optional
 
 import torch
+from torch.nn.utils.fusion import fuse_conv_bn_weights
 import torchmetrics
 
 from .base import ImageClassifier
@@ -52,6 +53,20 @@ class ConvBlock(torch.nn.Module):
         x = self.act(self.bn2(self.conv2(x)))
         return x
 
+    @torch.no_grad()
+    def fuse_bn(self):
+        '''Fold the BatchNorm layers into the convolutions. Only valid for inference: after fusing, the module
+        can't be trained or saved as a training checkpoint, since the BatchNorm layers and their state are gone.
+        Calling this more than once has no further effect.
+        '''
+        for conv, name in ((self.conv1, 'bn1'), (self.conv2, 'bn2')):
+            bn = getattr(self, name)
+            if not isinstance(bn, torch.nn.BatchNorm2d):
+                continue
+            conv.weight, conv.bias = fuse_conv_bn_weights(
+                conv.weight, conv.bias, bn.running_mean, bn.running_var, bn.eps, bn.weight, bn.bias)
+            setattr(self, name, torch.nn.Identity())
+
 
 ################################################################################
 # Lightning Module for PMG
@@ -63,6 +78,10 @@ class PMG(ImageClassifier):
     Args:
         feature_size (int): 
     '''
+    # configure_ddp needs find_unused_parameters=True, which fails with reentrant gradient checkpointing
+    # ("Expected to mark a variable ready only once")
+    supports_grad_checkpointing = False
+
     def __init__(
         self,
         feature_size: int=512,
@@ -85,9 +104,8 @@ class PMG(ImageClassifier):
         )
     
     def setup_model(self):
-        with torch.no_grad():
-            _x = torch.ones(1, 3, 33, 33)
-            channels = [v.shape[1] for v in self.backbone(_x)]
+        # channels of each returned stage, known statically from the timm feature extractor
+        channels = self.backbone.feature_info.channels()
 
         self.maxpool = torch.nn.AdaptiveMaxPool2d((1, 1))
         
@@ -104,6 +122,11 @@ class PMG(ImageClassifier):
         ])
         self.classifier_concat = Classifier(3 * (channels[-1] // 2), self.feature_size, self.num_classes)
 
+    def configure_ddp(self):
+        # each granularity level only uses part of the network, and there are several backward passes
+        # per batch, so the set of parameters receiving gradients changes within a single step
+        return {'find_unused_parameters': True, 'static_graph': False}
+
     def setup_metrics(self):
         super().setup_metrics()
         self.val_acc_combined = torchmetrics.Accuracy('multiclass', num_classes=self.num_classes)
@@ -159,6 +182,9 @@ class PMG(ImageClassifier):
         jigsaw = images.view(s1).permute(p1).flatten(1, 2)[bi, idx]
         jigsaw = jigsaw.reshape(s2).permute(p2).reshape(images.shape)
 
+        # keep the memory format of the input images (e.g. channels_last)
+        if images.is_contiguous(memory_format=torch.channels_last):
+            return jigsaw.contiguous(memory_format=torch.channels_last)
         return jigsaw.contiguous()
 
     def training_step(self, batch, batch_idx):
@@ -178,7 +204,7 @@ class PMG(ImageClassifier):
             loss = self.objective(v, y)
             if n == 1:
                 loss = loss * 2
-            opt.zero_grad()
+            opt.zero_grad(set_to_none=True)
             self.manual_backward(loss)
             opt.step()
             losses.append(loss.detach())
@@ -208,6 +234,14 @@ class PMG(ImageClassifier):
         self.log('val/acc', acc, prog_bar=True, **log_kw)
         self.log('val/acc_comb', acc_comb, prog_bar=True, **log_kw)
 
+    def fuse_bn(self):
+        '''Fold the BatchNorm layers of the conv blocks into their convolutions, for faster inference.
+        This is opt-in and permanent: call it on a model (or copy) that is only used for prediction, since
+        afterwards it can't be trained and its state dict no longer matches training checkpoints.
+        '''
+        for conv_block in self.conv_blocks:
+            conv_block.fuse_bn()
+
     def predict_step(self, batch, batch_idx):
         x, y = batch
         pred = sum(self(x, level=None))
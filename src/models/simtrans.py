@@ -5,7 +5,7 @@ SIM-Trans, from "SIM-Trans: Structure Information Modeling Transformer for Fine-
 Parts of this code are adapted directly from https://github.com/PKU-ICST-MIPL/SIM-Trans_ACMMM2022
 '''
 from typing import Any, Optional
-from pytorch_lightning.utilities.types import STEP_OUTPUT
+import warnings
 
 import timm
 import torch
@@ -41,8 +41,8 @@ class GraphConvolution(torch.nn.Module):
             self.bias.data.uniform_(-stdv, stdv)
 
     def forward(self, input, adj):
-        weight = self.weight.float()
-        support = torch.matmul(input, weight)
+        # the weight is not cast explicitly, so the matmul dtype follows autocast / the module precision
+        support = torch.matmul(input, self.weight)
         output = torch.matmul(adj, support)
         if self.bias is not None:
             return self.dropout(self.relu(output + self.bias))
@@ -109,8 +109,10 @@ class ExtractableAttentionWrapper(torch.nn.Module):
 
 
 class RelativeCoordPredictor(torch.nn.Module):
-    def __init__(self):
+    def __init__(self, size: int):
         super().__init__()
+        # the coordinate grid is the same for every forward pass, so it is built once
+        self.register_buffer('basic_label', self.build_basic_label(size), persistent=False)
 
     def forward(self, x):
         N, C, H, W = x.shape
@@ -124,13 +126,14 @@ class RelativeCoordPredictor(torch.nn.Module):
         thresholds = torch.mean(mask, dim=1, keepdim=True)
         binary_mask = mask.gt(thresholds).float().view(N, H, W)
 
+        # average over attention heads; reducing over dim 1 directly avoids transposing to (N, S, C)
         masked_x = x * binary_mask[:, None]
-        masked_x = masked_x.view(N, C, HW).transpose(1, 2).contiguous()  # (N, S, C)
-        reduced_x_max_index = masked_x.mean(dim=-1).argmax(dim=-1)
+        masked_mean = masked_x.view(N, C, HW).mean(dim=1)  # (N, S)
+        reduced_x_max_index = masked_mean.argmax(dim=-1)
 
         index = torch.arange(N, device=x.device)
 
-        label = self.build_basic_label(size, x.device)
+        label = self.basic_label
 
         # Build Label
         label = label.unsqueeze(0).expand((N, H, W, 2)).view(N, HW, 2)  # (N, S, 2)
@@ -148,8 +151,7 @@ class RelativeCoordPredictor(torch.nn.Module):
 
         relative_coord_total = torch.cat((relative_dist.unsqueeze(2), relative_angle.unsqueeze(2)), dim=-1)
 
-        # average over attention heads
-        position_weight = masked_x.mean(dim=-1, keepdim=True)
+        position_weight = masked_mean.unsqueeze(-1)
         position_weight = position_weight @ position_weight.transpose(1,2)
 
         return relative_coord_total, basic_anchor, position_weight, reduced_x_max_index
@@ -169,27 +171,29 @@ class PartStructureLayer(torch.nn.Module):
     Args:
         layer (torch.nn.Module): attention layer (timm.models.vision_transformer.Attention).
         hidden_size (int): hidden dimension of the transformer model.
+        grid_size (int): number of patches along each side of the image.
     '''
-    def __init__(self, layer: torch.nn.Module, hidden_size: int):
+    def __init__(self, layer: torch.nn.Module, hidden_size: int, grid_size: int):
         super().__init__()
 
         self.layer = layer
         self.layer.attn = ExtractableAttentionWrapper(self.layer.attn)
-        self.relative_coord_predictor = RelativeCoordPredictor()
+        self.relative_coord_predictor = RelativeCoordPredictor(grid_size)
         self.gcn = GCN(2, 512, hidden_size, dropout=0.1)
 
     def part_attention(self, attn):
         '''Replaces the Part_Attention class from the original code.'''
         # attention between CLS token and all other tokens
+        # NOTE: the original also computed the max attention value and index for each head, which
+        # were never used, so that reduction is skipped here
         attn = attn[:, :, 0, 1:]
-        max_value, max_idx = attn.max(2)
 
         B, C, num_patch = attn.shape
 
         H = int(num_patch**0.5)
         attention_map = attn.view(B, C, H, H)
 
-        return attention_map, attn, max_idx, max_value
+        return attention_map
     
     def part_structure(self, attention_map):
         B, C, H, W = attention_map.shape
@@ -208,7 +212,7 @@ class PartStructureLayer(torch.nn.Module):
         self.layer.attn.saved_attn_weights = None
 
         # part selection
-        attn_map = self.part_attention(attn_weights)[0]
+        attn_map = self.part_attention(attn_weights)
 
         # structure modeling
         structure = self.part_structure(attn_map)
@@ -252,13 +256,20 @@ class OverlapPatchEmbedding(torch.nn.Module):
 
 
 class SIMTrans(ImageClassifier):
+    # blocks save tensors during the forward pass, which would have no autograd history under checkpointing
+    supports_grad_checkpointing = False
+
     def __init__(
         self,
         drop_rate: float=0.0,
+        compile_modules: bool=False,
         base_conf: Optional[dict]=None,
         model_conf: Optional[dict]=None,
     ):
         self.drop_rate = drop_rate
+        # torch.compile requires torch >= 2.1 on Python 3.11 (the pinned torch 2.0.1 doesn't support it);
+        # if compilation isn't supported, the modules are left in eager mode
+        self.compile_modules = compile_modules
         # parent class initialization
         super().__init__(base_conf=base_conf, model_conf=model_conf)
 
@@ -270,10 +281,24 @@ class SIMTrans(ImageClassifier):
 
     def setup_model(self):
         hidden_size = self.backbone.embed_dim
+        grid_size = self.backbone.patch_embed.grid_size[0]
+        compile_modules = self.compile_modules
+        if compile_modules:
+            try:
+                import torch._dynamo
+                torch._dynamo.eval_frame.check_if_dynamo_supported()
+            except RuntimeError as e:
+                warnings.warn(f'compile_modules=True, but torch.compile is unavailable ({e}); running eagerly')
+                compile_modules = False
         # wrap the last 3 layers with PartStructureLayer
         for i in range(-3, 0):
             block = self.backbone.blocks[i]
-            self.backbone.blocks[i] = PartStructureLayer(block, hidden_size)
+            self.backbone.blocks[i] = PartStructureLayer(block, hidden_size, grid_size)
+            if compile_modules:
+                # the relative coordinate predictor is a chain of small elementwise and reduction ops
+                # with no parameters, which torch.compile can fuse into a few kernels
+                layer = self.backbone.blocks[i]
+                layer.relative_coord_predictor = torch.compile(layer.relative_coord_predictor)
         
         # remove the ViT classification head
         self.backbone.head = torch.nn.Identity()
@@ -291,17 +316,14 @@ class SIMTrans(ImageClassifier):
     def forward(self, x: torch.Tensor):
         last_hidden_state = self.backbone.forward_features(x)
 
-        # normalize and concatenate the CLS tokens from last three layers
-        cls_toks = []
+        # normalize and concatenate the CLS tokens from last three layers; the first two are stacked
+        # so they can be normalized with a single call
+        cls_toks = torch.stack([self.backbone.blocks[i].cls_token for i in (-3, -2)], 1)  # (B, 2, C)
+        cls_toks = self.backbone.norm(cls_toks).flatten(1)
         for i in range(-3, 0):
-            layer = self.backbone.blocks[i]
-            if i < -1:
-                cls_tok = self.backbone.norm(layer.cls_token)
-                cls_toks.append(cls_tok)
-            layer.cls_token = None
+            self.backbone.blocks[i].cls_token = None
         # NOTE: the last layer has already been normalized
-        cls_toks.append(last_hidden_state[:, 0])
-        cls_toks = torch.cat(cls_toks, -1)
+        cls_toks = torch.cat((cls_toks, last_hidden_state[:, 0]), -1)
 
         logits = self.head(cls_toks)
 
@@ -343,8 +365,8 @@ class SIMTrans(ImageClassifier):
     def training_step(self, batch: Any, batch_idx: int):
         logits, loss, accuracy = self.step(batch, self.train_accuracy, add_contrastive=True)
 
-        self.log('train/loss', loss, prog_bar=True, sync_dist=True)
-        self.log('train/acc', accuracy, prog_bar=True, sync_dist=True)
+        self.log('train/loss', loss, prog_bar=True)
+        self.log('train/acc', accuracy, prog_bar=True)
 
         return {'loss': loss, 'pred': logits}
 
@@ -10,6 +10,7 @@ import random
 from typing import Optional
 
 import torch
+from torch.nn.utils.fusion import fuse_conv_bn_weights
 from torchmetrics import Accuracy
 
 from .base import ImageClassifier
@@ -89,6 +90,19 @@ class ConvBNReLU(torch.nn.Module):
         x = self.bn(self.conv(x)) 
         return torch.nn.functional.relu(x, inplace=True)
 
+    @torch.no_grad()
+    def fuse_bn(self):
+        '''Fold the BatchNorm into the convolution. Only valid for inference: after fusing, the module can't
+        be trained or saved as a training checkpoint, since the BatchNorm layer and its state are gone.
+        Calling this more than once has no further effect.
+        '''
+        if not isinstance(self.bn, torch.nn.BatchNorm2d):
+            return
+        bn = self.bn
+        self.conv.weight, self.conv.bias = fuse_conv_bn_weights(
+            self.conv.weight, self.conv.bias, bn.running_mean, bn.running_var, bn.eps, bn.weight, bn.bias)
+        self.bn = torch.nn.Identity()
+
 
 ##############################################################################
 # Lightning Module for WSDAN
@@ -114,9 +128,8 @@ class WSDAN(ImageClassifier):
         )
 
     def setup_model(self):
-        with torch.no_grad():
-            out = self.backbone(torch.ones(1, 3, 33, 33))[-1]
-            channels = out.shape[1]
+        # channels of the final stage, known statically from the timm feature extractor
+        channels = self.backbone.feature_info.channels()[-1]
 
         self.attentions = ConvBNReLU(channels, self.num_attn)
         self.bap = BAP(pool='GAP')
@@ -147,7 +160,7 @@ class WSDAN(ImageClassifier):
             weights = normalize(weights, p=1, dim=1, out=weights)
             k_idx = torch.multinomial(weights, 2, replacement=True)
             b_idx = torch.arange(k_idx.shape[0], device=k_idx.device)
-            attention_map = attentions[b_idx[:,None], k_idx].contiguous()
+            attention_map = attentions[b_idx[:,None], k_idx]
         else:
             attention_map = attentions.mean(1, keepdim=True)
 
@@ -221,8 +234,9 @@ class WSDAN(ImageClassifier):
         logits_drop = self(drops, p_only=True)
 
         # calculate loss
-        obj = self.objective
-        loss = (1. / 3) * (obj(logits_raw, y) + obj(logits_crop, y) + obj(logits_drop, y))
+        # the mean over the concatenated predictions is the average of the three per-branch losses
+        logits_all = torch.cat((logits_raw, logits_crop, logits_drop), 0)
+        loss = self.objective(logits_all, y.repeat(3))
         loss = loss + self.centerloss(feature_mat, feature_center_batch)
 
         # calculate accuracies
@@ -238,6 +252,13 @@ class WSDAN(ImageClassifier):
 
         return loss
 
+    def fuse_bn(self):
+        '''Fold the BatchNorm of the attention layer into its convolution, for faster inference.
+        This is opt-in and permanent: call it on a model (or copy) that is only used for prediction, since
+        afterwards it can't be trained and its state dict no longer matches training checkpoints.
+        '''
+        self.attentions.fuse_bn()
+
     def inference_step(self, x):
         # full-image predictions
         logits_raw, _, attention_map = self(x)
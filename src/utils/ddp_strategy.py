@@ -0,0 +1,13 @@
+from pytorch_lightning.strategies import DDPStrategy
+
+
+class ConfigurableDDPStrategy(DDPStrategy):
+    '''DDPStrategy that lets the LightningModule override the DistributedDataParallel keyword arguments.
+    If the module defines a `configure_ddp` method, the dictionary it returns is merged on top of the
+    keyword arguments given to the strategy before the model is wrapped.
+    '''
+    def _setup_model(self, model):
+        configure_ddp = getattr(self.lightning_module, 'configure_ddp', None)
+        if configure_ddp is not None:
+            self._ddp_kwargs.update(configure_ddp())
+        return super()._setup_model(model)
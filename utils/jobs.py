@@ -164,6 +164,14 @@ def _setup_wandb(run_dir, config):
     OmegaConf.update(config, 'trainer.logger.0.init_args.id', wandb_id)
 
 
+def _setup_ddp(config):
+    # use the strategy from src/configs/trainer/ddp.yaml, unless the config already specifies one
+    if config.trainer.get('strategy', 'auto') != 'auto':
+        return
+    ddp_config = OmegaConf.load(os.path.join(os.environ['WORKDIR'], 'src/configs/trainer/ddp.yaml'))
+    config.trainer.strategy = ddp_config.trainer.strategy
+
+
 def setup_run_for_slurm(config, slurm_kw=None, log_dir=None, log_subdir=None, prefer='config', with_wandb=True):
     '''Sets everything up for launching a run. Syncs config and sbatch parameters, creates the run directory
     and sets corresponding paths in the config, and saves the config and bash file for launching the job
@@ -190,7 +198,7 @@ def setup_run_for_slurm(config, slurm_kw=None, log_dir=None, log_subdir=None, pr
     sync_cluster_and_config(config, slurm_kw, 'trainer.devices', 'gpus', prefer=prefer)
     sync_cluster_and_config(config, slurm_kw, 'data.init_args.num_workers', 'cpus_per_task', prefer=prefer)
     if slurm_kw['nodes'] > 1 or slurm_kw['gpus'] > 1:
-        config.trainer.strategy = 'ddp'
+        _setup_ddp(config)
 
     if with_wandb:
         # inject a wandb run id
@@ -224,7 +232,7 @@ def setup_run_for_local(config, log_dir, log_subdir=None, with_wandb=True):
     config.trainer.default_root_dir = run_dir
 
     if config.trainer.num_nodes > 1 or config.trainer.devices > 1:
-        config.trainer.strategy = 'ddp'
+        _setup_ddp(config)
 
     # inject a wandb run id
     if with_wandb: